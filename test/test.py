@@ -1,99 +1,163 @@
 #!/usr/bin/env python3
 
+import bisect
+import concurrent.futures
+import functools
 import itertools
-import numpy
+import logging
+import logging.handlers
+import math
 from os import path
 import os
 import random
 import re
+import shutil
+import signal
 import subprocess
 import sys
 import time
+import types
 
-TESTDIR = path.realpath(path.dirname(__file__))
+# The same few paths get resolved over and over again, so remember them.
+@functools.lru_cache(maxsize = None)
+def realpath(p):
+    return path.realpath(p)
+
+TESTDIR = realpath(path.dirname(__file__))
 
 if "LIBALLOCS_BASE" in os.environ:
     LIBALLOCS_BASE = os.environ["LIBALLOCS_BASE"]
 else:
     LIBALLOCS_BASE = path.join(TESTDIR, "../../liballocs")
-LIBALLOCS_BASE = path.realpath(LIBALLOCS_BASE)
+LIBALLOCS_BASE = realpath(LIBALLOCS_BASE)
 
 if "LIBCRUNCH_BASE" in os.environ:
     LIBCRUNCH_BASE = os.environ["LIBCRUNCH_BASE"]
 else:
     LIBCRUNCH_BASE = path.join(LIBALLOCS_BASE, "../libcrunch")
-LIBCRUNCH_BASE = path.realpath(LIBCRUNCH_BASE)
+LIBCRUNCH_BASE = realpath(LIBCRUNCH_BASE)
+
+LIBALLOCS_PRELOAD = realpath(path.join(LIBALLOCS_BASE,
+                                       "lib/liballocs_preload.so"))
+LIBCRUNCH_PRELOAD = realpath(path.join(LIBCRUNCH_BASE,
+                                       "lib/libcrunch_preload.so"))
 
 CLEAN_EXTS = ["-allocsites.c", "-allocsites.so", "-types.c", "-types.c.log.gz",
               "-types.so", ".allocs", ".allocs.rej", ".allocstubs.c",
               ".allocstubs.i", ".allocstubs.o", ".cil.c", ".cil.i", ".cil.s",
               ".i", ".i.allocs", ".makelog", ".o", ".o.fixuplog", ".objallocs",
               ".s", ".srcallocs", ".srcallocs.rej"]
+CLEAN_EXTS_SET = frozenset(CLEAN_EXTS)
+CLEAN_EXTS_TUPLE = tuple(CLEAN_EXTS)
 
 DEFAULT_SUMMARY_VALUE = 0
 
+# Commands are only echoed with -v. Messages are buffered and written out in
+# batches (or as soon as something goes wrong) rather than line by line.
+log = logging.getLogger("test")
+log.setLevel(logging.INFO)
+log.propagate = False
+log.addHandler(logging.handlers.MemoryHandler(8192,
+                   flushLevel = logging.ERROR,
+                   target = logging.StreamHandler(sys.stdout)))
+
+def flushLog():
+    for handler in log.handlers:
+        handler.flush()
+
+# The environment the tests inherit, snapshotted once. It is read-only: each
+# command gets a merged copy.
+BASE_ENV = types.MappingProxyType(dict(os.environ))
+
+# Start cmd with env added to our environment. stdout and stderr are as for
+# subprocess.Popen, and any pipes are opened in text mode.
+def startWithEnv(cmd, env, stdout, stderr):
+    # Only format the command line if it is going to be shown.
+    if log.isEnabledFor(logging.DEBUG):
+        assigns = ("%s='%s'" % (k, v) for (k, v) in env.items())
+        log.debug(" ".join(itertools.chain(assigns, cmd)))
+    # With nothing to override, let the child inherit our environment as is.
+    wholeEnv = {**BASE_ENV, **env} if env else None
+
+    return subprocess.Popen(cmd, stdout = stdout, stderr = stderr,
+                            env = wholeEnv, cwd = TESTDIR, text = True,
+                            encoding = "utf-8", errors = "replace")
+
+# Returns (returncode, stdout, stderr, elapsedTime).
 def runWithEnv(cmd, env = {}):
-    assigns = ["%s='%s'" % (e, env[e]) for e in env]
-    print(" ".join(assigns + cmd))
-    wholeEnv = dict(os.environ)
-    wholeEnv.update(env)
-
     startTime = time.time()
 
-    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE,
-                            stderr =  subprocess.PIPE, env = wholeEnv,
-                            cwd = TESTDIR)
+    proc = startWithEnv(cmd, env, subprocess.PIPE, subprocess.PIPE)
+    # On POSIX, communicate() drains both pipes with a selector in this thread
+    # (and waits for the process), so no reader threads are needed.
     (stdout, stderr) = proc.communicate()
-    returncode = proc.wait()
 
     elapsedTime = time.time() - startTime
 
-    stdout = stdout.decode()
-    stderr = stderr.decode()
+    return (proc.returncode, stdout, stderr, elapsedTime)
 
-    return (returncode, stdout, stderr, elapsedTime)
+# How much of a test's stderr to copy at once. This is the default capacity of
+# a pipe on Linux, so one read can usually empty it.
+PIPE_READ_SIZE = 1 << 16
 
-def parseSummaryLine(line):
-    found = False
-    ret = {}
-    def check(name, match):
-        nonlocal found, ret
-        if found: # Avoid rechecking once we've found a match for this line
-            return
-        m = re.match(match + ":?\\s+([0-9]+)", line)
-        if m:
-            found = True
-            ret = {name: int(m.group(1))}
+# Run cmd, throwing away its stdout and copying its stderr into the file
+# stderrLog, which must be open for reading too. The summary is picked out of
+# the log once the command has finished, so parsing it doesn't count towards
+# the elapsed time. Returns (returncode, elapsedTime, summary).
+def runParsingSummary(cmd, env, stderrLog):
+    startTime = time.time()
 
-    # Crunch summary outputs
-    check("c.begun", "checks begun")
-    check("c.aborted_typename", "checks aborted for bad typename")
-    check("c.remaining", "checks remaining")
-    check("c.lazy_heap", "of which did lazy heap type assignment")
-    check("c.failed_alloc", "checks failed inside allocation functions")
-    check("c.failed_other", "checks failed otherwise")
-    check("c.failed_suppression", "of which user suppression list matched")
-    check("c.nontriv", "checks nontrivially passed")
-    check("c.hit_cache", "of which hit __is_a cache")
+    proc = startWithEnv(cmd, env, subprocess.DEVNULL, subprocess.PIPE)
+    with proc.stderr:
+        shutil.copyfileobj(proc.stderr, stderrLog, PIPE_READ_SIZE)
+    returncode = proc.wait()
 
-    # Allocs summary outputs
-    check("a.abort_heap", "queries aborted for unindexed heap")
-    check("a.abort_stack", "queries aborted for unknown stackframes")
-    check("a.abort_static", "queries aborted for unknown static obj")
-    check("a.abort_storage", "queries aborted for unknown storage")
-    check("a.heap", "queries handled by heap case")
-    check("a.stack", "queries handled by stack case")
-    check("a.static", "queries handled by static case")
+    elapsedTime = time.time() - startTime
+
+    stderrLog.seek(0)
+    summary = parseSummary(stderrLog.read())
 
-    return ret
+    return (returncode, elapsedTime, summary)
 
-# Parse the summary generated by libcrunch and liballocs
+# Summary keys and the labels libcrunch/liballocs print them with.
+SUMMARY_LABELS = [
+    # Crunch summary outputs
+    ("c.begun", "checks begun"),
+    ("c.aborted_typename", "checks aborted for bad typename"),
+    ("c.remaining", "checks remaining"),
+    ("c.lazy_heap", "of which did lazy heap type assignment"),
+    ("c.failed_alloc", "checks failed inside allocation functions"),
+    ("c.failed_other", "checks failed otherwise"),
+    ("c.failed_suppression", "of which user suppression list matched"),
+    ("c.nontriv", "checks nontrivially passed"),
+    ("c.hit_cache", "of which hit __is_a cache"),
+
+    # Allocs summary outputs
+    ("a.abort_heap", "queries aborted for unindexed heap"),
+    ("a.abort_stack", "queries aborted for unknown stackframes"),
+    ("a.abort_static", "queries aborted for unknown static obj"),
+    ("a.abort_storage", "queries aborted for unknown storage"),
+    ("a.heap", "queries handled by heap case"),
+    ("a.stack", "queries handled by stack case"),
+    ("a.static", "queries handled by static case"),
+]
+
+# One regex matching any summary line, so that finditer can pick every label
+# out of a whole output in one pass. Longer labels come first so that one label
+# which is a prefix of another can't shadow it.
+# [^\S\n] is whitespace which doesn't run on to the next line.
+SUMMARY_KEYS = dict((label, name) for (name, label) in SUMMARY_LABELS)
+SUMMARY_RE = re.compile(r"^[^\S\n]*(" +
+                        "|".join(re.escape(label) for label in
+                                 sorted(SUMMARY_KEYS, key = len,
+                                        reverse = True)) +
+                        r"):?[^\S\n]+([0-9]+)", re.MULTILINE)
+
+# Parse the summary generated by libcrunch and liballocs. If a value is
+# reported more than once, the last one wins.
 def parseSummary(output):
-    lines = output.splitlines()
-    ret = {}
-    for l in lines:
-        ret.update(parseSummaryLine(l.strip()))
-    return ret
+    return dict((SUMMARY_KEYS[m.group(1)], int(m.group(2)))
+                for m in SUMMARY_RE.finditer(output))
 
 COMPILERS = dict()
 
@@ -131,11 +195,18 @@ COMPILER_LIST = list(COMPILERS.keys())
 COMPILER_LIST.sort()
 
 class Test:
+    # Name of the compiler the current output was built with, if any.
+    builtWith = None
+
+    # The log files for a stage are this plus ".stdout" and ".stderr".
+    def getLogName(self, compilerName, stage):
+        dirname = path.join(TESTDIR, "log", compilerName, self.getName())
+        # Other tests may be creating the same parent directories in parallel.
+        os.makedirs(dirname, exist_ok = True)
+        return path.join(dirname, stage)
+
     def writeToLog(self, compilerName, stage, stdout, stderr):
-        fname = path.join(TESTDIR, "log", compilerName, self.getName())
-        if not os.path.isdir(fname):
-            os.makedirs(fname)
-        fname = path.join(fname, stage)
+        fname = self.getLogName(compilerName, stage)
         with open(fname + ".stdout", "w") as fp:
             fp.write(stdout)
         with open(fname + ".stderr", "w") as fp:
@@ -147,39 +218,60 @@ class Test:
                             self.getBuildEnv(compiler))
         self.buildTime = cmdout[3]
         self.writeToLog(compiler.getName(), "build", cmdout[1], cmdout[2])
+        self.builtWith = compiler.getName() if cmdout[0] == 0 else None
         return cmdout[0]
 
-    def run(self, compiler):
-        cmdout = runWithEnv(self.getRunCmd(), self.getRunEnv())
-        self.runTime = cmdout[3]
-        self.writeToLog(compiler.getName(), "run", cmdout[1], cmdout[2])
-        self.actualSummary = parseSummary(cmdout[2])
-        return cmdout[0]
+    def isBuiltWith(self, compiler):
+        if self.builtWith != compiler.getName():
+            return False
+        if not path.exists(self.out_fname):
+            return False
+        return path.getmtime(self.out_fname) >= path.getmtime(self.src_fname)
 
-    def checkSummary(self):
-        passed = True
-        for key in self.correctSummary:
-            if key not in self.actualSummary:
-                print("Error: Summary value %s not reported, should be %d" %
-                        (key, self.correctSummary[key]))
-                passed = False
-                continue
-            if self.correctSummary[key] != self.actualSummary[key]:
-                print("Error: Summary value %s should be '%s', got '%s'" %
-                      (key, self.correctSummary[key], self.actualSummary[key]))
-                passed = False
-
-        # Everything else should be zero
-        for key in self.actualSummary:
-            if key not in self.correctSummary:
-                if self.actualSummary[key] != DEFAULT_SUMMARY_VALUE:
-                    print("Error: Summary value %s should be '%s', got '%s'" %
-                          (key, DEFAULT_SUMMARY_VALUE,
-                           self.actualSummary[key]))
-                    passed = False
-        return passed
-
-    def getCleanFiles(self):
+    # Repeated runs with the same compiler can reuse the previous build, as
+    # long as nothing else has been built over it since. In that case
+    # buildTime is None, since no build was timed.
+    def buildIfNeeded(self, compiler):
+        if self.isBuiltWith(compiler):
+            self.buildTime = None
+            return 0
+        return self.build(compiler)
+
+    def run(self, compiler):
+        # Only stderr is kept (it has the summary), and it is written to the
+        # log as it is read rather than being held in memory. The summary is
+        # then read back from the log.
+        fname = self.getLogName(compiler.getName(), "run")
+        if path.exists(fname + ".stdout"):
+            os.unlink(fname + ".stdout")
+        with open(fname + ".stderr", "w+") as fp:
+            (returncode, self.runTime, self.actualSummary) = \
+                runParsingSummary(self.getRunCmd(), self.getRunEnv(), fp)
+        return returncode
+
+    # Returns a list of error messages, which is empty if the summary is right.
+    def getSummaryErrors(self):
+        expected = self.correctSummary
+        actual = self.actualSummary
+        # Everything not in the expected summary should be zero.
+        errors = [key for key in expected.keys() | actual.keys()
+                  if key not in actual or
+                     actual[key] != expected.get(key, DEFAULT_SUMMARY_VALUE)]
+
+        messages = []
+        for key in sorted(errors):
+            if key not in actual:
+                messages += ["Error: Summary value %s not reported, "
+                             "should be %d" % (key, expected[key])]
+            else:
+                messages += ["Error: Summary value %s should be '%s', "
+                             "got '%s'" % (key, expected.get(key,
+                                 DEFAULT_SUMMARY_VALUE), actual[key])]
+        return messages
+
+    # Returns (directory, stem) pairs: clean() removes 'stem' followed by any
+    # of CLEAN_EXTS from each directory, and the output file itself.
+    def getCleanStems(self):
         return []
 
     def getBuildEnv(self, compiler):
@@ -189,26 +281,48 @@ class Test:
         return {}
 
     def clean(self):
-        for f in self.getCleanFiles():
-            if path.exists(f):
-                os.unlink(f)
+        # One scandir per directory is much cheaper than checking whether each
+        # of the possible output files exists.
+        for (directory, stem) in self.getCleanStems():
+            if not path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if not entry.name.startswith(stem):
+                        continue
+                    ext = entry.name[len(stem):]
+                    if ext in CLEAN_EXTS_SET or \
+                       (ext == "" and entry.path == self.out_fname and
+                        entry.is_file(follow_symlinks = False)):
+                        os.unlink(entry.path)
 
 class AllocsTest(Test):
     def __init__(self, fname, buildEnv = {}, runEnv = {},
                  fail = False, flags = [], summary = {}):
         self.testName = path.splitext(fname)[0]
-        self.src_fname = path.realpath(path.join(TESTDIR, fname))
+        self.src_fname = realpath(path.join(TESTDIR, fname))
         self.out_fname = path.splitext(self.src_fname)[0]
         self.buildEnv = buildEnv
         self.runEnv = runEnv
         self.shouldFail = fail
         self.flags = flags
         self.correctSummary = summary
+        self.buildCmds = {}
+        # These only depend on the filenames, and clean() runs before every
+        # build, so work them out once.
+        self.cleanStems = self.makeCleanStems()
 
     def getName(self):
         return self.testName
 
+    # The build command only depends on the compiler, so only work it out once
+    # per compiler. Callers get a copy they are free to modify.
     def getBuildCmd(self, compiler):
+        if compiler.getName() not in self.buildCmds:
+            self.buildCmds[compiler.getName()] = self.makeBuildCmd(compiler)
+        return list(self.buildCmds[compiler.getName()])
+
+    def makeBuildCmd(self, compiler):
         cmd = compiler.getAllocsCmd() \
             + ["-std=c99", "-DUSE_STARTUP_BRK"] \
             + self.flags \
@@ -219,30 +333,31 @@ class AllocsTest(Test):
         return self.buildEnv
 
     def getRunEnv(self):
-        liballocs = path.join(LIBALLOCS_BASE, "lib/liballocs_preload.so")
-        ld_preload = {"LD_PRELOAD": path.realpath(liballocs)}
-        return dict(self.runEnv, **ld_preload)
+        return dict(self.runEnv, LD_PRELOAD = LIBALLOCS_PRELOAD)
 
     def getRunCmd(self):
         return [self.out_fname]
 
-    def getCleanFiles(self):
-        files = [self.out_fname + e for e in CLEAN_EXTS]
-        files += [path.splitext(self.src_fname)[0] + e for e in CLEAN_EXTS]
-        files += [self.out_fname]
+    def getCleanStems(self):
+        return self.cleanStems
+
+    def makeCleanStems(self):
+        stems = [path.split(self.out_fname),
+                 path.split(path.splitext(self.src_fname)[0])]
 
         if "ALLOCSITES_BASE" in os.environ:
             sites = os.environ["ALLOCSITES_BASE"]
         else:
             sites = "/usr/lib/allocsites"
-        sites = path.realpath(sites)
-        sites = sites + path.realpath(self.out_fname)
-        files += [sites + e for e in CLEAN_EXTS]
+        sites = realpath(sites)
+        sites = sites + realpath(self.out_fname)
+        stems += [path.split(sites)]
 
-        return files
+        # The output file usually shares its name with the source.
+        return tuple(dict.fromkeys(stems))
 
 class CrunchTest(AllocsTest):
-    def getBuildCmd(self, compiler):
+    def makeBuildCmd(self, compiler):
         cmd = compiler.getCrunchCmd() \
             + ["-D_GNU_SOURCE", "-std=c99", "-DUSE_STARTUP_BRK"] \
             + ["-fno-eliminate-unused-debug-types"] \
@@ -256,9 +371,7 @@ class CrunchTest(AllocsTest):
         return cmd
 
     def getRunEnv(self):
-        liballocs = path.join(LIBCRUNCH_BASE, "lib/libcrunch_preload.so")
-        ld_preload = {"LD_PRELOAD": path.realpath(liballocs)}
-        return dict(self.runEnv, **ld_preload)
+        return dict(self.runEnv, LD_PRELOAD = LIBCRUNCH_PRELOAD)
 
 class CrunchMakefileTest(CrunchTest):
     def __init__(self, directory, summary = {}):
@@ -266,7 +379,7 @@ class CrunchMakefileTest(CrunchTest):
         self.out_fname = path.join(directory, path.basename(directory))
         AllocsTest.__init__(self, self.out_fname + ".c", summary = summary)
 
-    def getBuildCmd(self, compiler):
+    def makeBuildCmd(self, compiler):
         cmd = ["make", "-C", path.join(TESTDIR, self.directory)]
         return cmd
 
@@ -276,14 +389,17 @@ class CrunchMakefileTest(CrunchTest):
     def getName(self):
         return self.directory
 
-    def getCleanFiles(self):
-        return []
+    def makeCleanStems(self):
+        return ()
 
+# The flags for a package can't change during a run, so only ask once. The
+# result is a tuple, so the cached copy can't be modified by a caller.
+@functools.lru_cache(maxsize = None)
 def pkg_config(pkg):
     cmd = ["pkg-config", "--cflags", "--libs", pkg]
     ret = subprocess.check_output(cmd)
     ret = ret.decode()
-    return ret.split()
+    return tuple(ret.split())
 
 def register_tests():
     tests = {}
@@ -312,7 +428,7 @@ def register_tests():
                         "g_slice_alloc(Z)p g_slice_alloc0(Z)p"}
     addAllocsTest("allocs/multi_alloc.c", summary = {},
                   flags = ["-Wl,--no-as-needed"] +
-                          pkg_config("glib-2.0") +
+                          list(pkg_config("glib-2.0")) +
                           ["-Wl,--as-needed"],
                   buildEnv = multiAllocEnv, runEnv = multiAllocEnv)
 
@@ -454,6 +570,8 @@ def zshcomp(tests, prefix = ""):
         print(prefix, c)
     # HACK: To enable complete for the -rNUM option, just add them here.
     print("-r1\n-r2\n-r3\n-r4\n-r5\n-r10")
+    print("-j1\n-j2\n-j4\n-j8")
+    print("-v")
 
 def helpAndExit(tests):
     print("Usage: %s TEST ..." % sys.argv[0])
@@ -466,10 +584,13 @@ def parseArgs(allTests):
     testNames = set()
     compilersToUse = set()
     numRepeats = 1
+    # Run serially unless -jN asks otherwise, since only a serial run records
+    # timings.
+    numJobs = 1
 
     if len(argv) == 0:
         helpAndExit(allTests)
-        return [ret, 0]
+        return [ret, 0, 0]
 
     if "ALL" in argv:
         for tn in allTests:
@@ -478,29 +599,37 @@ def parseArgs(allTests):
         argv.remove("ALL")
 
     # For each argument, add every test that is a prefix match of that
-    # argument.
+    # argument. The matches form a contiguous range of the sorted test names.
+    sortedNames = sorted(allTests)
     for arg in argv:
         if arg.startswith("-r"):
             numRepeats = int(arg[2:])
             continue
+        elif arg.startswith("-j"):
+            numJobs = max(1, int(arg[2:]))
+            continue
+        elif arg == "-v":
+            log.setLevel(logging.DEBUG)
+            continue
         elif arg in COMPILERS:
             compilersToUse.add(COMPILERS[arg])
             continue
 
         numMatched = 0
-        for tn in allTests:
-            if tn.startswith(arg):
-                testNames.add(tn)
-                numMatched += 1
+        i = bisect.bisect_left(sortedNames, arg)
+        while i < len(sortedNames) and sortedNames[i].startswith(arg):
+            testNames.add(sortedNames[i])
+            numMatched += 1
+            i += 1
         if numMatched == 0:
             print("Error: No tests match '%s'." % arg)
-            return [{}, 0]
+            return [{}, 0, 0]
 
     if len(compilersToUse) == 0:
         compilersToUse = set(COMPILERS.values())
 
     ret = set(itertools.product(compilersToUse, testNames))
-    return [ret, numRepeats]
+    return [ret, numRepeats, numJobs]
 
 def boxMessage(msg):
     assert type(msg) == str
@@ -510,6 +639,29 @@ def boxMessage(msg):
     print("| " + msg + " |")
     print("+" + width * "-" + "+")
 
+# Running mean and standard deviation of a series of times, updated as each
+# one is added (Welford's algorithm) so the samples themselves aren't kept.
+class RunningStat:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def getMean(self):
+        return self.mean
+
+    # Population standard deviation, as numpy.std gives by default.
+    def getSD(self):
+        if self.n == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.n)
+
 class Timings:
     def __init__(self):
         self.times = {}
@@ -521,8 +673,8 @@ class Timings:
             self.times[name] = dict()
 
         if compiler.getName() not in self.times[name]:
-            self.times[name][compiler.getName()] = []
-        self.times[name][compiler.getName()].append(time)
+            self.times[name][compiler.getName()] = RunningStat()
+        self.times[name][compiler.getName()].add(time)
 
         if compiler.getName() not in self.compilerList:
             self.compilerList.append(compiler.getName())
@@ -536,21 +688,20 @@ class Timings:
         if len(testTimes) != len(self.compilerList):
             return False
 
-        fp.write("\\texttt{" + testName.replace("_", "\\_") + "}")
-        fp.write("\t" + str(xpos))
+        # Build the whole row and write it in one go.
+        row = ["\\texttt{" + testName.replace("_", "\\_") + "}", str(xpos)]
         for compName in self.compilerList:
-            times = testTimes[compName]
-            fp.write("\t" + str(numpy.mean(times)))
-            fp.write("\t" + str(numpy.std(times)))
-        fp.write("\n")
+            stat = testTimes[compName]
+            row += [str(stat.getMean()), str(stat.getSD())]
+        fp.write("\t".join(row) + "\n")
         return True
 
     def write(self, fname):
-        with open(fname, "w") as fp:
-            fp.write("TestName\tXPos")
+        with open(fname, "w", buffering = 1 << 20) as fp:
+            header = ["TestName", "XPos"]
             for compName in self.compilerList:
-                fp.write("\t" + compName + "Mean\t" + compName + "SD")
-            fp.write("\n")
+                header += [compName + "Mean", compName + "SD"]
+            fp.write("\t".join(header) + "\n")
             allNames = list(self.times.keys())
             allNames.sort()
             xpos = 0
@@ -559,7 +710,110 @@ class Timings:
                 if didWrite:
                     xpos += 1
 
-def runTestList(tests, testsToRun, buildTimes, runTimes):
+# Read back the means from a file written by Timings.write, as a dict from
+# (test name, compiler name) to the mean time. A missing file gives no times,
+# and lines which can't be parsed (e.g. from a truncated file) are skipped.
+def readTimingMeans(fname):
+    means = {}
+    if not path.exists(fname):
+        return means
+    with open(fname) as fp:
+        header = fp.readline().rstrip("\n").split("\t")
+        compNames = [h[:-len("Mean")] for h in header[2::2]]
+        for line in fp:
+            fields = line.rstrip("\n").split("\t")
+            testName = fields[0][len("\\texttt{"):-1].replace("\\_", "_")
+            try:
+                row = {(testName, compName): float(mean)
+                       for (compName, mean) in zip(compNames, fields[2::2])}
+            except (ValueError, IndexError):
+                continue
+            means.update(row)
+    return means
+
+# Build and run a single test, returning the stage it failed at (or "passed"),
+# the time taken by the build (None if it was reused) and the run, and any
+# error messages. The messages are returned rather than printed, since this
+# runs in a worker process and they belong next to the test's result. With
+# reuseBuild the previous build is used if it is still valid, so only use that
+# when the build times aren't being recorded: otherwise a test repeated with
+# -rN would have fewer than N build times.
+def runTest(T, compiler, reuseBuild = False):
+    if reuseBuild:
+        retcode = T.buildIfNeeded(compiler)
+    else:
+        retcode = T.build(compiler)
+    if retcode != 0:
+        return ("build", None, None, [])
+    retcode = T.run(compiler)
+    if compiler.getShouldPass() and retcode != 0:
+        return ("returncode", None, None, [])
+    if compiler.getShouldPass():
+        messages = T.getSummaryErrors()
+        if messages:
+            return ("summary", None, None, messages)
+    return ("passed", T.buildTime, T.runTime, [])
+
+# Run a group of (compiler name, test) pairs one after the other. Everything in
+# a group writes the same output files, so the group as a whole is the unit of
+# work handed to each worker process. After ^C the rest of the group is
+# skipped, and only the results so far are returned.
+def runTestGroup(group, reuseBuilds = False):
+    results = []
+    for (compName, T) in group:
+        if interrupted:
+            break
+        results += [(compName, T.getName(),
+                     runTest(T, COMPILERS[compName], reuseBuilds))]
+    # Worker processes don't flush the log on exit.
+    flushLog()
+    return results
+
+# Set in a worker process by ^C, so that it stops before its next test.
+interrupted = False
+
+def interruptWorker(signum, frame):
+    global interrupted
+    interrupted = True
+
+# Set up each worker process once, when the pool starts it.
+def initWorker(logLevel):
+    log.setLevel(logLevel)
+    # Let the main process deal with ^C, so the pool doesn't break. This has
+    # to be a handler rather than SIG_IGN: ignored signals stay ignored across
+    # exec, which would leave the tests themselves immune to ^C, whereas a
+    # handler goes back to the default in the test processes. The test that
+    # is running gets the ^C too, so the worker only has to not start another.
+    signal.signal(signal.SIGINT, interruptWorker)
+
+# Run (compiler name, test) pairs on a pool of workers, yielding each group's
+# results as soon as it finishes. Pairs which share an output file can't run at
+# the same time, so they are grouped and each group runs in one worker. This
+# means the tests don't run in the order they were given: the groups are
+# started longest first (LPT), so the run doesn't end waiting on one slow
+# group that started late. Groups with no previous timings might be slow, so
+# they go first too.
+def runGroupsInParallel(pairs, executor, expectedTimes):
+    groups = {}
+    for (compName, T) in pairs:
+        groups.setdefault(T.out_fname, []).append((compName, T))
+
+    def expectedTime(group):
+        return sum(expectedTimes.get((T.getName(), compName), math.inf)
+                   for (compName, T) in group)
+    groups = sorted(groups.values(), key = expectedTime, reverse = True)
+
+    # Parallel runs don't record timings, so they can save time by reusing
+    # builds within a group.
+    futures = [executor.submit(runTestGroup, group, True) for group in groups]
+    for future in concurrent.futures.as_completed(futures):
+        yield future.result()
+
+# expectedTimes maps (test name, compiler name) to how long that test is
+# expected to take, if known. If executor is None the tests run serially, in
+# the order given.
+def runTestList(tests, testsToRun, buildTimes, runTimes, executor,
+                expectedTimes = {}):
     nonexist = 0
     passed = 0
     cancelled = 0
@@ -568,35 +822,49 @@ def runTestList(tests, testsToRun, buildTimes, runTimes):
     failed_summary = []
     total = len(testsToRun)
 
+    pairs = []
+    for (compiler, tn) in testsToRun:
+        if tn not in tests:
+            print("Error: No such test: \'" + tn + "\'")
+            nonexist += 1
+            continue
+        pairs += [(compiler.getName(), tests[tn])]
+
     try:
-        for (compiler, tn) in testsToRun:
-            if tn not in tests:
-                print("Error: No such test: \'" + tn + "\'")
-                nonexist += 1
-                continue
-            T = tests[tn]
-            if T.build(compiler) != 0:
-                failed_build += [compiler.getName() + ":" + tn]
-                boxMessage("Failed " + compiler.getName() + ":" + tn)
-                continue
-            retcode = T.run(compiler)
-            if compiler.getShouldPass() and retcode != 0:
-                failed_returncode += [compiler.getName() + ":" + tn]
-                boxMessage("Failed " + compiler.getName() + ":" + tn)
-                continue
-            if compiler.getShouldPass() and not T.checkSummary():
-                failed_summary += [compiler.getName() + ":" + tn]
-                boxMessage("Failed " + compiler.getName() + ":" + tn)
-                continue
-            boxMessage("Passed " + compiler.getName() + ":" + tn)
-            print("\n")
+        if executor is None:
+            # Run the tests one at a time in this process, in the order given.
+            results = (runTestGroup([pair]) for pair in pairs)
+        else:
+            results = runGroupsInParallel(pairs, executor, expectedTimes)
+        for groupResults in results:
+            for (compName, tn, (result, buildTime, runTime, messages)) \
+                    in groupResults:
+                name = compName + ":" + tn
+                for m in messages:
+                    print(m)
+                if result == "build":
+                    failed_build += [name]
+                elif result == "returncode":
+                    failed_returncode += [name]
+                elif result == "summary":
+                    failed_summary += [name]
+                if result != "passed":
+                    boxMessage("Failed " + name)
+                    continue
+                boxMessage("Passed " + name)
+                print("\n")
 
-            buildTimes.add(compiler, tn, T.buildTime)
-            runTimes.add(compiler, tn, T.runTime)
+                if buildTime is not None:
+                    buildTimes.add(COMPILERS[compName], tn, buildTime)
+                runTimes.add(COMPILERS[compName], tn, runTime)
 
-            passed += 1
+                passed += 1
     except KeyboardInterrupt:
-        cancelled = total - passed \
+        # Groups which haven't started are dropped. The ones already running
+        # stop after their current test, since the workers got the ^C too.
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
+        cancelled = total - passed - nonexist \
                   - len(failed_build) \
                   - len(failed_returncode) \
                   - len(failed_summary)
@@ -629,34 +897,57 @@ def main():
     if "CLEAN" in sys.argv:
         for t in tests:
             tests[t].clean()
+        # DirEntry caches the file type from the directory listing, so this
+        # walk doesn't need to stat anything.
         def cleanDir(directory):
-            for f in os.listdir(directory):
-                fullpath = path.join(directory, f)
-                if path.isdir(fullpath):
-                    cleanDir(fullpath)
-                    continue
-                for e in CLEAN_EXTS:
-                    if fullpath.endswith(e) and path.exists(fullpath):
-                        os.unlink(fullpath)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks = False):
+                        cleanDir(entry.path)
+                    elif entry.name.endswith(CLEAN_EXTS_TUPLE):
+                        os.unlink(entry.path)
         cleanDir(TESTDIR)
         return 0
 
-    [testsToRun, numRepeats] = parseArgs(tests)
+    [testsToRun, numRepeats, numJobs] = parseArgs(tests)
 
     if len(testsToRun) == 0 or numRepeats == 0:
         return
 
+    # Use the timings from the last run to decide what to start first.
+    buildFname = path.join(TESTDIR, "buildTimes.dat")
+    runFname = path.join(TESTDIR, "runTimes.dat")
+    expectedTimes = readTimingMeans(buildFname)
+    for (key, t) in readTimingMeans(runFname).items():
+        expectedTimes[key] = expectedTimes.get(key, 0.0) + t
+
     buildTimes = Timings()
     runTimes = Timings()
 
-    # Combine all repeats into one huge list, then shuffle it
+    # Combine all repeats into one huge list, then shuffle it. Only a serial
+    # run keeps this order; a parallel run reorders by group.
     testsToRun = numRepeats * list(testsToRun)
     random.shuffle(testsToRun)
 
-    runTestList(tests, testsToRun, buildTimes, runTimes)
-
-    buildTimes.write(path.join(TESTDIR, "buildTimes.dat"))
-    runTimes.write(path.join(TESTDIR, "runTimes.dat"))
+    if numJobs == 1:
+        runTestList(tests, testsToRun, buildTimes, runTimes, None)
+    else:
+        # One pool of workers is used for the whole run.
+        with concurrent.futures.ProcessPoolExecutor(max_workers = numJobs,
+                                                    initializer = initWorker,
+                                                    initargs = (log.level,)) \
+                as executor:
+            runTestList(tests, testsToRun, buildTimes, runTimes, executor,
+                        expectedTimes)
+
+    # Tests running alongside each other slow each other down, so only a
+    # serial run gives timings worth keeping.
+    if numJobs == 1:
+        buildTimes.write(buildFname)
+        runTimes.write(runFname)
+    else:
+        print("Not writing timings, since tests ran in parallel. "
+              "Use -j1 to record them.")
 
 
 if __name__ == "__main__":